@@ -0,0 +1,86 @@
+"""
+Shared Gmail API authentication for the email sender and setup helper.
+Loads, refreshes and caches OAuth 2.0 credentials so each process
+authenticates once and builds the Gmail service once.
+"""
+
+import os
+import json
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import requests
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+
+# Gmail API configuration
+GMAIL_SEND_SCOPE = 'https://www.googleapis.com/auth/gmail.send'
+SCOPES = (GMAIL_SEND_SCOPE,)
+CREDENTIALS_FILE = 'credentials.json'
+TOKEN_FILE = 'token.json'
+
+# Keep-alive session reused for OAuth token refreshes
+AUTH_REQUEST = Request(requests.Session())
+
+def save_token(creds: Credentials) -> None:
+    """Save credentials to token.json, skipping the write if the token is unchanged."""
+    if os.path.exists(TOKEN_FILE):
+        try:
+            with open(TOKEN_FILE, 'r') as f:
+                if json.load(f).get('token') == creds.token:
+                    return
+        except (OSError, ValueError):
+            pass
+
+    with open(TOKEN_FILE, 'w') as token:
+        token.write(creds.to_json())
+
+@lru_cache(maxsize=1)
+def get_creds(scopes: Tuple[str, ...] = SCOPES) -> Optional[Credentials]:
+    """Authenticate with Gmail API using OAuth 2.0 (cached for the process)."""
+    creds = None
+
+    # Check if token file exists
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, list(scopes))
+
+    # If there are no (valid) credentials available, let the user log in
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            print("🔄 Refreshing expired credentials...")
+            creds.refresh(AUTH_REQUEST)
+        else:
+            if not os.path.exists(CREDENTIALS_FILE):
+                print(f"❌ Error: {CREDENTIALS_FILE} not found!")
+                print("Please download your OAuth 2.0 credentials from Google Cloud Console:")
+                print("1. Go to https://console.cloud.google.com/")
+                print("2. Select your project (or create one)")
+                print("3. Enable Gmail API")
+                print("4. Go to Credentials → Create Credentials → OAuth 2.0 Client ID")
+                print("5. Application type: Desktop application")
+                print("6. Download the JSON file and save as 'credentials.json'")
+                return None
+
+            print("🔐 Starting OAuth authentication...")
+            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, list(scopes))
+            creds = flow.run_local_server(port=0)
+
+        # Save the credentials for the next run
+        save_token(creds)
+        print("✅ Authentication successful!")
+
+    return creds
+
+@lru_cache(maxsize=1)
+def get_service(scopes: Tuple[str, ...] = SCOPES) -> Optional[object]:
+    """Build the Gmail API service (cached for the process)."""
+    creds = get_creds(scopes)
+    if not creds:
+        return None
+
+    # build() already defaults to the discovery document bundled with
+    # google-api-python-client (static_discovery=True) and then ignores
+    # cache_discovery; both are spelled out only to make that explicit
+    return build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
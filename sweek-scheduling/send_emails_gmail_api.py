@@ -7,22 +7,29 @@ Uses Google OAuth 2.0 for authentication.
 
 import os
 import sys
+import argparse
+import asyncio
+import atexit
 import base64
 import json
+import queue
+import re
 import time
 import random
+import secrets
+import threading
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional, Tuple
 
-from google.auth.transport.requests import Request
+import aiohttp
+from tqdm import tqdm
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
+from gmail_auth import AUTH_REQUEST, get_creds
+
 # Load environment variables
 load_dotenv()
 
@@ -30,23 +37,45 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 APP_BASE_URL = os.getenv("APP_BASE_URL", "http://localhost:3000")
+STUDENT_PAGE_SIZE = 1000  # Rows per Supabase request (PostgREST's default max)
 
 # Gmail API configuration
-SCOPES = ['https://www.googleapis.com/auth/gmail.send']
-CREDENTIALS_FILE = 'credentials.json'
-TOKEN_FILE = 'token.json'
 FROM_EMAIL = os.getenv("FROM_EMAIL")
 FROM_NAME = os.getenv("FROM_NAME", "V1 @ Michigan")
+GMAIL_BATCH_URL = "https://gmail.googleapis.com/batch/gmail/v1"
+GMAIL_SEND_PATH = "/gmail/v1/users/me/messages/send"
 
 # Rate limiting configuration
 EMAIL_DELAY_MIN = float(os.getenv("EMAIL_DELAY_MIN", "0.5"))  # Gmail API is faster
 EMAIL_DELAY_MAX = float(os.getenv("EMAIL_DELAY_MAX", "1.5"))
-BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))  # Gmail API allows more
-BATCH_DELAY = int(os.getenv("BATCH_DELAY", "30"))  # Shorter delays
+# Target send rate; defaults to the average rate implied by the delay range
+EMAIL_RPS = float(os.getenv("EMAIL_RPS", str(2.0 / (EMAIL_DELAY_MIN + EMAIL_DELAY_MAX))))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 
+# Retry backoff ("full jitter": sleep a uniform random time up to the capped exponential)
+BASE_DELAY = 0.5
+MAX_DELAY = 60.0  # Cap when Gmail is rate limiting us
+TRANSIENT_MAX_DELAY = 5.0  # Cap for other transient failures
+QUOTA_DELAY = 300.0  # Per-user quota windows last minutes, not seconds
+
+# Statuses worth retrying; anything else (400, 401, 403, 404, ...) fails immediately
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# Gmail error reasons (often sent with a 403) that mean "slow down" rather than "forbidden"
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "20"))  # Send workers / in-flight batch requests
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))  # Gmail recommends at most 50 per batch request
+
 # Logging
-LOG_FILE = f"email_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+LOG_FILE = f"email_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+LOG_JSON_FILE = LOG_FILE.replace('.ndjson', '.json')
+
+# Failed sends waiting for a retry pass; kept on disk so an interrupted run can resume
+RETRY_FILE = 'retry_queue.ndjson'
+_log_queue = queue.Queue()
+_log_thread = None
+
+# Serializes token refreshes from concurrent batches
+_refresh_lock = threading.Lock()
 
 # Email template
 EMAIL_TEMPLATE = """Hey {name},
@@ -66,8 +95,69 @@ Best,
 The V1 Team
 """
 
+# Static parts of every message, split around the placeholders and encoded once
+EMAIL_SUBJECT = "🎉 Your Startup Week Company Matches Are Ready!"
+HEADER_PREFIX = f"From: {FROM_NAME} <{FROM_EMAIL}>\nTo: ".encode('utf-8')
+HEADER_SUFFIX = f"\nSubject: {EMAIL_SUBJECT}\n\n".encode('utf-8')
+_body_prefix, _body_rest = EMAIL_TEMPLATE.split("{name}")
+_body_mid, _body_suffix = _body_rest.split("{magic_link}")
+BODY_PREFIX = _body_prefix.encode('utf-8')
+BODY_MID = _body_mid.encode('utf-8')
+BODY_SUFFIX = _body_suffix.encode('utf-8')
+MAGIC_LINK_PREFIX = f"{APP_BASE_URL}/s/".encode('utf-8')
+
+class GmailApiError(Exception):
+    """Non-2xx response from the Gmail API."""
+
+    def __init__(self, status: int, content: str):
+        super().__init__(f"HTTP {status}: {content}")
+        self.status = status
+        self.content = content
+
+class RateLimiter:
+    """Shared limiter that spaces request start times to a target rate across all senders."""
+
+    def __init__(self, rps: float):
+        self.interval = 1 / rps
+        self.next_t = time.monotonic()
+
+    async def acquire(self, n: int = 1) -> None:
+        """Reserve slots for n sends and wait until the first one arrives."""
+        now = time.monotonic()
+        wait = self.next_t - now
+        self.next_t = max(now, self.next_t) + n * self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+def _log_writer() -> None:
+    """Drain queued log entries into the NDJSON log file (runs on a daemon thread)."""
+    try:
+        # Line-buffered so each entry hits disk whole
+        log_fh = open(LOG_FILE, 'a', buffering=1)
+    except Exception as e:
+        print(f"Warning: Could not open log file: {e}")
+        log_fh = None
+    
+    while True:
+        entry = _log_queue.get()
+        if entry is None:
+            # Sentinel from close_log: everything before it has been written
+            if log_fh:
+                log_fh.close()
+            _log_queue.task_done()
+            return
+        
+        try:
+            if log_fh:
+                log_fh.write(json.dumps(entry) + '\n')
+        except Exception as e:
+            print(f"Warning: Could not write to log file: {e}")
+        finally:
+            _log_queue.task_done()
+
 def log_email_attempt(email: str, name: str, success: bool, error: str = None) -> None:
-    """Log email attempt to JSON file."""
+    """Queue email attempt for the background log writer."""
+    global _log_thread
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "email": email,
@@ -76,21 +166,36 @@ def log_email_attempt(email: str, name: str, success: bool, error: str = None) -
         "error": error
     }
     
+    if _log_thread is None:
+        _log_thread = threading.Thread(target=_log_writer, daemon=True)
+        _log_thread.start()
+        # Flush and close the log on any exit, including Ctrl-C or a crash,
+        # before the daemon writer is killed with entries still queued
+        atexit.register(close_log)
+    
+    _log_queue.put(log_entry)
+
+def close_log() -> None:
+    """Write every queued log entry, then close the log file."""
+    if _log_thread is not None and _log_thread.is_alive():
+        _log_queue.put(None)
+        _log_thread.join()
+
+def export_log_json() -> None:
+    """Wait for queued log entries, then convert the NDJSON log into a JSON array file."""
+    if _log_thread is None:
+        return
+    
+    _log_queue.join()
+    
     try:
-        # Read existing log or create new
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, 'r') as f:
-                logs = json.load(f)
-        else:
-            logs = []
-        
-        logs.append(log_entry)
+        with open(LOG_FILE, 'r') as f:
+            logs = [json.loads(line) for line in f if line.strip()]
         
-        # Write back to file
-        with open(LOG_FILE, 'w') as f:
+        with open(LOG_JSON_FILE, 'w') as f:
             json.dump(logs, f, indent=2)
     except Exception as e:
-        print(f"Warning: Could not write to log file: {e}")
+        print(f"Warning: Could not export JSON log: {e}")
 
 def get_supabase_client() -> Client:
     """Create and return Supabase client."""
@@ -99,220 +204,419 @@ def get_supabase_client() -> Client:
     
     return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
-def get_all_students() -> List[Dict]:
-    """Fetch all active students from the database."""
+def iter_students() -> Iterator[List[Dict]]:
+    """Yield pages of active students from the database as they are fetched."""
     supabase = get_supabase_client()
+    last_id = None
     
+    while True:
+        query = (supabase.table("sweek_students")
+                 .select("id,email,name,token")
+                 .eq("is_active", True)
+                 # Students without an email or token can't be emailed; drop them in SQL
+                 .not_.is_("email", "null")
+                 .not_.is_("token", "null")
+                 .neq("email", "")
+                 .neq("token", ""))
+        # Page by id (keyset) rather than offset: rows added or removed while
+        # earlier pages are sending can't shift later pages into overlaps or gaps
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        query = query.order("id").limit(STUDENT_PAGE_SIZE)
+        
+        # Retry transient failures; if the page still can't be fetched, raise so
+        # the run is reported as incomplete instead of silently skipping students
+        for attempt in range(MAX_RETRIES):
+            try:
+                response = query.execute()
+                break
+            except Exception as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                tqdm.write(f"⚠️  Error fetching students (attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+                time.sleep(backoff_delay(attempt, TRANSIENT_MAX_DELAY))
+        
+        if response.data:
+            yield response.data
+        # A short page is the last one; Supabase caps responses at 1000 rows
+        if len(response.data) < STUDENT_PAGE_SIZE:
+            return
+        last_id = response.data[-1]['id']
+
+def create_message(to_email: str, to_name: str, token: str) -> Dict:
+    """Create a message for an email."""
+    # Only the recipient, name and token differ between messages
+    message = b''.join([
+        HEADER_PREFIX, to_email.encode('utf-8'), HEADER_SUFFIX,
+        BODY_PREFIX, str(to_name).encode('utf-8'),
+        BODY_MID, MAGIC_LINK_PREFIX, token.encode('utf-8'), BODY_SUFFIX
+    ])
+    
+    # Encode the message; base64 output is pure ASCII, so skip the UTF-8 decoder
+    raw_message = base64.urlsafe_b64encode(message).decode('ascii')
+    
+    return {
+        'raw': raw_message
+    }
+
+def backoff_delay(attempt: int, cap: float) -> float:
+    """Full-jitter backoff delay for the given retry attempt."""
+    return random.uniform(0, min(cap, BASE_DELAY * (2 ** attempt)))
+
+def error_reason(content: str) -> str:
+    """Extract the Gmail error reason (e.g. rateLimitExceeded) from an error response body."""
     try:
-        response = supabase.table("sweek_students").select("*").eq("is_active", True).execute()
-        return response.data
-    except Exception as e:
-        print(f"Error fetching students: {e}")
+        return json.loads(content).get('error', {}).get('errors', [{}])[0].get('reason', '')
+    except (ValueError, AttributeError, IndexError):
+        return ''
+
+def refresh_creds(creds: Credentials) -> None:
+    """Refresh the access token once, even if several batches notice it expired."""
+    with _refresh_lock:
+        if not creds.valid:
+            creds.refresh(AUTH_REQUEST)
+
+async def auth_headers(creds: Credentials) -> Dict[str, str]:
+    """Return the Authorization header, refreshing the access token if it expired."""
+    if not creds.valid:
+        # Refreshing is a blocking HTTP call; keep it off the event loop
+        await asyncio.to_thread(refresh_creds, creds)
+    return {'Authorization': f'Bearer {creds.token}'}
+
+def build_batch_body(boundary: str, messages: List[Dict]) -> str:
+    """Build a multipart/mixed batch body with one messages.send call per part."""
+    parts = []
+    for i, message in enumerate(messages):
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <item{i}>\r\n\r\n"
+            f"POST {GMAIL_SEND_PATH}\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            f"{json.dumps(message)}\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts)
+
+def parse_batch_response(content_type: str, text: str) -> Dict[int, Tuple[int, str]]:
+    """Split a multipart/mixed batch response into item index -> (status, body)."""
+    boundary = content_type.split("boundary=", 1)[1].strip('"')
+    results = {}
+    
+    for part in text.split(f"--{boundary}")[1:]:
+        if part.startswith("--"):
+            break
+        
+        # Part headers, then the embedded HTTP status line + headers, then the body
+        sections = re.split(r"\r?\n\r?\n", part.strip(), maxsplit=2)
+        content_id = re.search(r"Content-ID:\s*<response-item(\d+)>", sections[0], re.IGNORECASE)
+        if not content_id or len(sections) < 2:
+            continue
+        
+        status = int(sections[1].split()[1])
+        body = sections[2] if len(sections) > 2 else ""
+        results[int(content_id.group(1))] = (status, body)
+    
+    return results
+
+async def post_batch(session: aiohttp.ClientSession, creds: Credentials,
+                     messages: List[Dict]) -> List[Tuple[Optional[int], str]]:
+    """POST messages as one Gmail batch request and return (status, body) per message."""
+    boundary = f"batch_{secrets.token_hex(8)}"
+    headers = {
+        **(await auth_headers(creds)),
+        'Content-Type': f'multipart/mixed; boundary={boundary}',
+    }
+    
+    async with session.post(GMAIL_BATCH_URL, data=build_batch_body(boundary, messages), headers=headers) as resp:
+        text = await resp.text()
+        if resp.status != 200:
+            raise GmailApiError(resp.status, text)
+        parsed = parse_batch_response(resp.headers.get('Content-Type', ''), text)
+    
+    return [parsed.get(i, (None, "Missing from batch response")) for i in range(len(messages))]
+
+def queue_retry(student: Dict, attempts: int, delay: float) -> None:
+    """Append a failed send to the retry queue file."""
+    entry = {
+        "email": student['email'],
+        "name": student.get('name', 'Student'),
+        "token": student['token'],
+        "attempts": attempts,
+        "next_retry_at": time.time() + delay
+    }
+    
+    with open(RETRY_FILE, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def load_retry_queue() -> List[Dict]:
+    """Read all entries from the retry queue file."""
+    if not os.path.exists(RETRY_FILE):
         return []
+    
+    with open(RETRY_FILE, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
 
-def create_email_content(name: str, token: str) -> str:
-    """Create personalized email content."""
-    magic_link = f"{APP_BASE_URL}/s/{token}"
-    return EMAIL_TEMPLATE.format(name=name, magic_link=magic_link)
+def save_retry_queue(entries: List[Dict]) -> None:
+    """Rewrite the retry queue file, removing it once nothing is left."""
+    if not entries:
+        if os.path.exists(RETRY_FILE):
+            os.remove(RETRY_FILE)
+        return
+    
+    with open(RETRY_FILE, 'w') as f:
+        f.writelines(json.dumps(entry) + '\n' for entry in entries)
 
-def authenticate_gmail() -> Optional[object]:
-    """Authenticate with Gmail API using OAuth 2.0."""
-    creds = None
+async def send_batch(session: aiohttp.ClientSession, sem: asyncio.Semaphore, limiter: RateLimiter,
+                     creds: Credentials, students: List[Dict]) -> List[Optional[bool]]:
+    """Send emails as one Gmail batch request; None marks a failure queued for retry."""
+    messages = [create_message(s['email'], s.get('name', 'Student'), s['token']) for s in students]
     
-    # Check if token file exists
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    # Wait for enough send slots, then send the batch
+    await limiter.acquire(len(students))
+    try:
+        async with sem:
+            responses = await post_batch(session, creds, messages)
+    except GmailApiError as error:
+        # The whole batch was rejected, so every item shares its status
+        responses = [(error.status, error.content)] * len(students)
+    except Exception as e:
+        responses = [(None, str(e))] * len(students)
     
-    # If there are no (valid) credentials available, let the user log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            print("🔄 Refreshing expired credentials...")
-            creds.refresh(Request())
+    results = []
+    for student, (status, content) in zip(students, responses):
+        email = student['email']
+        name = student.get('name', 'Student')
+        
+        if status == 200:
+            # Log successful send
+            log_email_attempt(email, name, True)
+            results.append(True)
+            continue
+        
+        attempts = student.get('attempts', 0) + 1
+        if status is None:
+            error_msg = f"Unexpected error (attempt {attempts}/{MAX_RETRIES}): {content}"
+        else:
+            error_msg = f"Gmail API error (attempt {attempts}/{MAX_RETRIES}): HTTP {status}: {content}"
+        tqdm.write(f"⚠️  {email}: {error_msg}")
+        
+        reason = error_reason(content) if status else ''
+        if reason == 'quotaExceeded':
+            # Wait out the quota window, and only try once more
+            retryable = attempts == 1
+            delay = QUOTA_DELAY + random.uniform(0, 60)
+        elif status == 429 or reason in RATE_LIMIT_REASONS:
+            retryable = True
+            delay = backoff_delay(attempts - 1, MAX_DELAY)
         else:
-            if not os.path.exists(CREDENTIALS_FILE):
-                print(f"❌ Error: {CREDENTIALS_FILE} not found!")
-                print("Please download your OAuth 2.0 credentials from Google Cloud Console:")
-                print("1. Go to https://console.cloud.google.com/")
-                print("2. Select your project (or create one)")
-                print("3. Enable Gmail API")
-                print("4. Go to Credentials → Create Credentials → OAuth 2.0 Client ID")
-                print("5. Application type: Desktop application")
-                print("6. Download the JSON file and save as 'credentials.json'")
-                return None
-            
-            print("🔐 Starting OAuth authentication...")
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
+            # Network errors have no status and are always retryable
+            retryable = status is None or status in RETRYABLE_STATUS
+            delay = backoff_delay(attempts - 1, TRANSIENT_MAX_DELAY)
         
-        # Save the credentials for the next run
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
-        print("✅ Authentication successful!")
+        if retryable and attempts < MAX_RETRIES:
+            # Queue for the retry pass instead of stalling this batch
+            queue_retry(student, attempts, delay)
+            results.append(None)
+        else:
+            log_email_attempt(email, name, False, error_msg)
+            results.append(False)
     
-    return creds
+    return results
 
-def create_message(to_email: str, to_name: str, token: str) -> Dict:
-    """Create a message for an email."""
-    body = create_email_content(to_name, token)
+async def send_chunks(session: aiohttp.ClientSession, sem: asyncio.Semaphore, limiter: RateLimiter,
+                      creds: Credentials, students: List[Dict]) -> List[Optional[bool]]:
+    """Split students into Gmail batch requests and send them concurrently."""
+    chunks = [students[i:i + GMAIL_BATCH_SIZE] for i in range(0, len(students), GMAIL_BATCH_SIZE)]
+    chunk_results = await asyncio.gather(*(
+        send_batch(session, sem, limiter, creds, chunk) for chunk in chunks
+    ))
+    return [sent for chunk_result in chunk_results for sent in chunk_result]
+
+def record_results(totals: Dict, students: List[Dict], results: List[Optional[bool]], pbar: tqdm) -> None:
+    """Add send results to the running totals; queued retries are counted when they resolve."""
+    for student, sent in zip(students, results):
+        name = student.get('name', 'Student')
+        if sent:
+            totals['successful'] += 1
+        elif sent is False:
+            totals['failed'] += 1
+            totals['failed_emails'].append(f"{name} ({student['email']}) - send failed")
+            tqdm.write(f"❌ Failed to send email to {name}")
+        else:
+            continue
+        pbar.update(1)
+    pbar.set_postfix(ok=totals['successful'], fail=totals['failed'])
+
+async def process_retries(session: aiohttp.ClientSession, sem: asyncio.Semaphore, limiter: RateLimiter,
+                          creds: Credentials, totals: Dict, pbar: tqdm) -> None:
+    """Resend queued failures as they come due until the retry queue is empty."""
+    while True:
+        entries = load_retry_queue()
+        if not entries:
+            return
+        
+        now = time.time()
+        due = [e for e in entries if e['next_retry_at'] <= now]
+        if not due:
+            await asyncio.sleep(min(e['next_retry_at'] for e in entries) - now)
+            continue
+        
+        # Keep the due entries on disk while they are resent, so a crash mid-pass
+        # loses nothing (at worst a few are sent twice). send_batch only appends
+        # re-queued failures, so afterwards the file is the loaded entries
+        # followed by new ones; drop just the entries that were sent
+        results = await send_chunks(session, sem, limiter, creds, due)
+        requeued = load_retry_queue()[len(entries):]
+        save_retry_queue([e for e in entries if e['next_retry_at'] > now] + requeued)
+        record_results(totals, due, results, pbar)
+
+async def produce_students(send_queue: asyncio.Queue, totals: Dict) -> None:
+    """Feed students into the send queue page by page, then a None sentinel."""
+    try:
+        pages = iter_students()
+        while True:
+            # The Supabase client is synchronous, so fetch pages off the event loop
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            for student in page:
+                await send_queue.put(student)
+    except Exception as e:
+        # Students after the failed page were never fetched or emailed
+        totals['fetch_error'] = str(e)
+        tqdm.write(f"❌ Error fetching students, no more will be sent: {e}")
     
-    message = f"""From: {FROM_NAME} <{FROM_EMAIL}>
-To: {to_email}
-Subject: 🎉 Your Startup Week Company Matches Are Ready!
+    # Always stop the workers, even after a fetch error
+    await send_queue.put(None)
 
-{body}"""
+async def send_worker(send_queue: asyncio.Queue, session: aiohttp.ClientSession, sem: asyncio.Semaphore,
+                      limiter: RateLimiter, creds: Credentials, totals: Dict, pbar: tqdm) -> None:
+    """Take up to GMAIL_BATCH_SIZE students at a time off the send queue and send them."""
+    while True:
+        student = await send_queue.get()
+        if student is None:
+            # Leave the sentinel for the other workers
+            send_queue.put_nowait(None)
+            return
+        
+        batch_students = [student]
+        while len(batch_students) < GMAIL_BATCH_SIZE:
+            try:
+                student = send_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if student is None:
+                send_queue.put_nowait(None)
+                break
+            batch_students.append(student)
+        
+        totals['total'] += len(batch_students)
+        pbar.total = totals['total']
+        pbar.refresh()
+        
+        results = await send_batch(session, sem, limiter, creds, batch_students)
+        record_results(totals, batch_students, results, pbar)
+
+async def send_batches(creds: Credentials, retry_only: bool = False) -> Dict:
+    """Send to students as they stream in, then resend queued failures."""
+    totals = {'successful': 0, 'failed': 0, 'failed_emails': [], 'total': 0, 'fetch_error': None}
     
-    # Encode the message
-    raw_message = base64.urlsafe_b64encode(message.encode('utf-8')).decode('utf-8')
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = RateLimiter(EMAIL_RPS)
+    # One pooled connector for the whole run; keep idle connections open for
+    # longer than the rate limiter's gap between full batches so they don't
+    # redo the TLS handshake
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY, keepalive_timeout=GMAIL_BATCH_SIZE / EMAIL_RPS + 30)
+    pbar = tqdm(total=0, unit='email')
     
-    return {
-        'raw': raw_message
-    }
+    async with aiohttp.ClientSession(connector=connector) as session:
+        if retry_only:
+            totals['total'] = pbar.total = len(load_retry_queue())
+        else:
+            # Workers send continuously while pages are still being fetched; the
+            # shared rate limiter paces them, so there is no pause between batches
+            send_queue = asyncio.Queue(maxsize=STUDENT_PAGE_SIZE)
+            await asyncio.gather(
+                produce_students(send_queue, totals),
+                *(send_worker(send_queue, session, sem, limiter, creds, totals, pbar)
+                  for _ in range(MAX_CONCURRENCY))
+            )
+        
+        # Second pass: resend failures queued during the main pass
+        await process_retries(session, sem, limiter, creds, totals, pbar)
+    
+    pbar.close()
+    return totals
 
-def send_email(service: object, to_email: str, to_name: str, token: str) -> bool:
-    """Send email using Gmail API with retry logic."""
-    for attempt in range(MAX_RETRIES):
-        try:
-            message = create_message(to_email, to_name, token)
-            
-            # Send the message
-            sent_message = service.users().messages().send(
-                userId='me',
-                body=message
-            ).execute()
-            
-            # Log successful send
-            log_email_attempt(to_email, to_name, True)
-            return True
-            
-        except HttpError as error:
-            error_msg = f"Gmail API error (attempt {attempt + 1}/{MAX_RETRIES}): {error}"
-            print(f"⚠️  {error_msg}")
-            
-            if attempt < MAX_RETRIES - 1:
-                # Wait before retry with exponential backoff
-                wait_time = (2 ** attempt) + random.uniform(0, 1)
-                print(f"⏳ Retrying in {wait_time:.1f} seconds...")
-                time.sleep(wait_time)
-            else:
-                log_email_attempt(to_email, to_name, False, error_msg)
-                return False
-                
-        except Exception as e:
-            error_msg = f"Unexpected error (attempt {attempt + 1}/{MAX_RETRIES}): {e}"
-            print(f"❌ {error_msg}")
-            
-            if attempt < MAX_RETRIES - 1:
-                wait_time = (2 ** attempt) + random.uniform(0, 1)
-                print(f"⏳ Retrying in {wait_time:.1f} seconds...")
-                time.sleep(wait_time)
-            else:
-                log_email_attempt(to_email, to_name, False, error_msg)
-                return False
-    
-    return False
-
-def send_all_emails() -> None:
+def send_all_emails(retry_only: bool = False) -> None:
     """Send emails to all students using Gmail API."""
     print("🚀 Starting email sending process with Gmail API...")
     print(f"📝 Logging to: {LOG_FILE}")
-    print(f"⚙️  Rate limiting: {EMAIL_DELAY_MIN}-{EMAIL_DELAY_MAX}s between emails")
-    print(f"📦 Batch size: {BATCH_SIZE} emails per batch")
-    print(f"⏱️  Batch delay: {BATCH_DELAY}s between batches")
-    print(f"🔄 Max retries: {MAX_RETRIES} per email")
+    print(f"⚙️  Rate limiting: {EMAIL_RPS:.2f} emails/s")
+    print(f"🔀 Concurrency: {MAX_CONCURRENCY} workers sending Gmail batches of up to {GMAIL_BATCH_SIZE} emails")
+    print(f"🔄 Max retries: {MAX_RETRIES} per email (queued in {RETRY_FILE})")
     
     # Authenticate with Gmail
-    creds = authenticate_gmail()
+    creds = get_creds()
     if not creds:
         print("❌ Failed to authenticate with Gmail API")
         return
     
-    # Build the Gmail service
-    try:
-        service = build('gmail', 'v1', credentials=creds)
-        print("✅ Gmail API service initialized")
-    except Exception as e:
-        print(f"❌ Failed to build Gmail service: {e}")
-        return
+    # A full run resends every student, so retries left from an earlier run are stale
+    if not retry_only and os.path.exists(RETRY_FILE):
+        print(f"🗑️  Discarding retries left in {RETRY_FILE} by a previous run")
+        os.remove(RETRY_FILE)
     
-    # Get all students
-    students = get_all_students()
+    # Stream students from the database straight into the send pipeline
+    results = asyncio.run(send_batches(creds, retry_only))
+    export_log_json()
+    successful = results['successful']
+    failed = results['failed']
+    failed_emails = results['failed_emails']
+    fetch_error = results['fetch_error']
     
-    if not students:
-        print("❌ No students found in database")
+    if not results['total']:
+        if fetch_error:
+            print(f"❌ Could not fetch students: {fetch_error}")
+            sys.exit(1)
+        elif retry_only:
+            print(f"✅ No queued retries in {RETRY_FILE}")
+        else:
+            print("❌ No students found in database")
         return
     
-    print(f"📧 Found {len(students)} students to email")
-    
-    # Track results
-    successful = 0
-    failed = 0
-    failed_emails = []
-    
-    # Process in batches
-    total_batches = (len(students) + BATCH_SIZE - 1) // BATCH_SIZE
-    
-    for batch_num in range(total_batches):
-        start_idx = batch_num * BATCH_SIZE
-        end_idx = min(start_idx + BATCH_SIZE, len(students))
-        batch_students = students[start_idx:end_idx]
-        
-        print(f"\n📦 Processing batch {batch_num + 1}/{total_batches} ({len(batch_students)} emails)")
-        print("-" * 60)
-        
-        # Send emails in current batch
-        for i, student in enumerate(batch_students, 1):
-            global_index = start_idx + i
-            email = student.get('email')
-            name = student.get('name', 'Student')
-            token = student.get('token')
-            
-            if not email or not token:
-                print(f"⚠️  Skipping student {global_index}: missing email or token")
-                failed += 1
-                failed_emails.append(f"{name} ({email}) - missing data")
-                log_email_attempt(email or "unknown", name, False, "Missing email or token")
-                continue
-            
-            print(f"📤 [{global_index}/{len(students)}] Sending to {name} ({email})...")
-            
-            if send_email(service, email, name, token):
-                successful += 1
-                print(f"✅ Email sent successfully to {name}")
-            else:
-                failed += 1
-                failed_emails.append(f"{name} ({email}) - send failed")
-                print(f"❌ Failed to send email to {name}")
-            
-            # Random delay between emails
-            if global_index < len(students):  # Don't delay after the last email
-                delay = random.uniform(EMAIL_DELAY_MIN, EMAIL_DELAY_MAX)
-                print(f"⏳ Waiting {delay:.1f}s before next email...")
-                time.sleep(delay)
-        
-        # Delay between batches (except after the last batch)
-        if batch_num < total_batches - 1:
-            print(f"\n⏸️  Batch {batch_num + 1} complete. Waiting {BATCH_DELAY}s before next batch...")
-            time.sleep(BATCH_DELAY)
-    
     # Print summary
     print("\n" + "="*60)
     print("📊 EMAIL SENDING SUMMARY")
     print("="*60)
     print(f"✅ Successful: {successful}")
     print(f"❌ Failed: {failed}")
-    print(f"📧 Total: {len(students)}")
-    print(f"📝 Log file: {LOG_FILE}")
+    print(f"📧 Total: {results['total']}")
+    print(f"📝 Log file: {LOG_FILE} (JSON array: {LOG_JSON_FILE})")
     
     if failed_emails:
         print("\n❌ Failed emails:")
         for failed_email in failed_emails:
             print(f"  - {failed_email}")
     
+    if fetch_error:
+        print(f"\n❌ Email sending INCOMPLETE: fetching students failed ({fetch_error})")
+        print("   Students after the failed page were not emailed; the ones above were.")
+        print(f"💡 Check {LOG_FILE} for who was sent before re-running")
+        sys.exit(1)
+    
     print("\n🎉 Email sending process completed!")
     print(f"💡 Check {LOG_FILE} for detailed logs")
 
 def main():
     """Main function."""
+    parser = argparse.ArgumentParser(description='Send Startup Week match emails via the Gmail API')
+    parser.add_argument('--retries', action='store_true',
+                        help=f'Only resend emails queued in {RETRY_FILE}, to finish the retry pass of a run '
+                             'whose main pass completed (an interrupted main pass needs a full re-run)')
+    args = parser.parse_args()
+    
     print("🎯 Startup Week Email Sender (Gmail API)")
     print("="*50)
     
@@ -332,7 +636,11 @@ def main():
         sys.exit(1)
     
     # Confirm before sending
-    print("⚠️  This will send emails to ALL active students in the database.")
+    if args.retries:
+        print(f"⚠️  This will resend only the emails queued in {RETRY_FILE}.")
+        print("   Students an interrupted main pass never reached are not in the queue.")
+    else:
+        print("⚠️  This will send emails to ALL active students in the database.")
     response = input("Are you sure you want to continue? (yes/no): ").lower().strip()
     
     if response not in ['yes', 'y']:
@@ -340,7 +648,7 @@ def main():
         sys.exit(0)
     
     # Send emails
-    send_all_emails()
+    send_all_emails(retry_only=args.retries)
 
 if __name__ == "__main__":
     main()
@@ -6,19 +6,13 @@ This script helps verify your Gmail API setup and test authentication.
 
 import os
 import sys
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-# Gmail API scopes
-SCOPES = ['https://www.googleapis.com/auth/gmail.send',
-'https://www.googleapis.com/auth/gmail.readonly']
+from gmail_auth import AUTH_REQUEST, CREDENTIALS_FILE, GMAIL_SEND_SCOPE, TOKEN_FILE, get_creds, get_service, save_token
 
 def check_credentials_file():
     """Check if credentials.json exists."""
-    if not os.path.exists('credentials.json'):
+    if not os.path.exists(CREDENTIALS_FILE):
         print("❌ credentials.json not found!")
         print("\n📋 To fix this:")
         print("1. Go to https://console.cloud.google.com/")
@@ -36,44 +30,25 @@ def test_authentication():
     """Test Gmail API authentication."""
     print("\n🔐 Testing Gmail API authentication...")
     
-    creds = None
-    
     # Check if token file exists
-    if os.path.exists('token.json'):
+    if os.path.exists(TOKEN_FILE):
         print("📄 Found existing token.json")
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    
-    # If there are no (valid) credentials available, let the user log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            print("🔄 Refreshing expired credentials...")
-            creds.refresh(Request())
-        else:
-            print("🔐 Starting OAuth authentication...")
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-        print("✅ Authentication successful!")
-    else:
-        print("✅ Using existing valid credentials")
     
-    return creds
+    return get_creds()
 
-def test_gmail_service(creds):
+def test_gmail_service():
     """Test Gmail API service initialization."""
     print("\n🔧 Testing Gmail API service...")
     
     try:
-        service = build('gmail', 'v1', credentials=creds)
+        service = get_service()
         print("✅ Gmail API service initialized successfully")
         
-        # Test getting user profile
-        profile = service.users().getProfile(userId='me').execute()
-        email_address = profile.get('emailAddress')
-        print(f"📧 Authenticated as: {email_address}")
+        # users().getProfile() would need a read scope on top of gmail.send,
+        # so report the configured sender instead of asking Gmail
+        email_address = os.getenv("FROM_EMAIL")
+        if email_address:
+            print(f"📧 Sending as: {email_address}")
         
         return service, email_address
         
@@ -84,32 +59,32 @@ def test_gmail_service(creds):
         print(f"❌ Unexpected error: {e}")
         return None, None
 
-def test_send_permissions(service):
-    """Test if we have send permissions."""
+def test_send_permissions(creds):
+    """Test if we have send permissions; returns None if Google didn't say."""
     print("\n📤 Testing send permissions...")
     
-    try:
-        # Try to get the user's profile (requires basic Gmail access)
-        profile = service.users().getProfile(userId='me').execute()
-        
-        # Check if we can access the messages endpoint
-        # We won't actually send, just check permissions
-        service.users().messages().list(userId='me', maxResults=1).execute()
-        
+    # creds.scopes is only what we asked for; granted_scopes is what Google
+    # actually granted. It is filled in by the OAuth flow or a token refresh,
+    # but not when credentials are loaded from token.json, so refresh to learn it
+    if creds.granted_scopes is None and creds.refresh_token:
+        try:
+            creds.refresh(AUTH_REQUEST)
+        except Exception as e:
+            print(f"❌ Could not refresh credentials: {e}")
+            return False
+        save_token(creds)
+    
+    if creds.granted_scopes is None:
+        print("⚠️  Google did not report the granted scopes; send permission not verified")
+        return None
+    
+    if GMAIL_SEND_SCOPE in creds.granted_scopes:
         print("✅ Send permissions verified")
         return True
-        
-    except HttpError as error:
-        if error.resp.status == 403:
-            print("❌ Insufficient permissions")
-            print("💡 Make sure you granted 'Send email' permission during OAuth")
-            return False
-        else:
-            print(f"❌ Gmail API error: {error}")
-            return False
-    except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        return False
+    
+    print("❌ Insufficient permissions")
+    print("💡 Make sure you granted 'Send email' permission during OAuth")
+    return False
 
 def main():
     """Main setup function."""
@@ -127,13 +102,14 @@ def main():
         sys.exit(1)
     
     # Step 3: Test Gmail service
-    service, email_address = test_gmail_service(creds)
+    service, email_address = test_gmail_service()
     if not service:
         print("❌ Gmail service initialization failed")
         sys.exit(1)
     
     # Step 4: Test send permissions
-    if not test_send_permissions(service):
+    send_verified = test_send_permissions(creds)
+    if send_verified is False:
         print("❌ Send permissions test failed")
         sys.exit(1)
     
@@ -141,9 +117,13 @@ def main():
     print("\n" + "=" * 40)
     print("🎉 Gmail API Setup Complete!")
     print("=" * 40)
-    print(f"✅ Authenticated as: {email_address}")
+    if email_address:
+        print(f"✅ Sending as: {email_address}")
     print("✅ Gmail API service ready")
-    print("✅ Send permissions verified")
+    if send_verified:
+        print("✅ Send permissions verified")
+    else:
+        print("⚠️  Send permissions not verified (Google did not report the granted scopes)")
     print("\n💡 You can now run: python send_emails_gmail_api.py")
     
     # Check environment variables
@@ -0,0 +1,79 @@
+-- Server-side sync for `python sync_script.py --rpc`
+--
+-- Upserts companies and students and replaces their matches in a single
+-- transaction, so a sync is one round trip and never leaves partial state.
+-- Run this once in the Supabase SQL editor (re-run it after changes).
+
+create extension if not exists pgcrypto;
+
+drop function if exists sweek_sync(jsonb, jsonb, jsonb);
+
+create or replace function sweek_sync(companies jsonb, students jsonb, matches jsonb)
+returns table(id uuid, email text, name text, token text)
+language plpgsql
+set search_path = public, extensions
+as $$
+#variable_conflict use_column
+declare
+  new_emails text[];
+begin
+  -- Companies: only overwrite the columns the CSV provides
+  insert into sweek_companies as c (name, blurb, learn_more_url, logo_slug, scheduling_url, website_url, is_active)
+  select x.name, x.blurb, x.learn_more_url, x.logo_slug, x.scheduling_url, x.website_url, true
+  from jsonb_to_recordset(companies)
+    as x(name text, blurb text, learn_more_url text, logo_slug text, scheduling_url text, website_url text)
+  on conflict (name) do update set
+    blurb = coalesce(excluded.blurb, c.blurb),
+    learn_more_url = coalesce(excluded.learn_more_url, c.learn_more_url),
+    logo_slug = coalesce(excluded.logo_slug, c.logo_slug),
+    scheduling_url = excluded.scheduling_url,
+    website_url = coalesce(excluded.website_url, c.website_url),
+    is_active = true;
+
+  -- Existing students: update names, keep their tokens
+  update sweek_students s
+  set name = x.name
+  from jsonb_to_recordset(students) as x(email text, name text)
+  where s.email = x.email and s.name is distinct from x.name;
+
+  -- New students: same token format as secrets.token_urlsafe(32), stored with its SHA-256 hex
+  with inserted as (
+    insert into sweek_students (email, name, token, token_hash, is_active)
+    select n.email, n.name, n.token, encode(digest(n.token, 'sha256'), 'hex'), true
+    from (
+      select x.email, x.name,
+             rtrim(translate(encode(gen_random_bytes(32), 'base64'), '+/', '-_'), '=') as token
+      from jsonb_to_recordset(students) as x(email text, name text)
+      where not exists (select 1 from sweek_students s where s.email = x.email)
+    ) n
+    on conflict (email) do nothing
+    returning email
+  )
+  select coalesce(array_agg(inserted.email), '{}') into new_emails from inserted;
+
+  -- Matches: replace everything for the synced students
+  delete from sweek_matches m
+  using sweek_students s
+  where m.student_id = s.id
+    and s.email in (select x.email from jsonb_to_recordset(students) as x(email text));
+
+  insert into sweek_matches (student_id, company_id, tier, stage)
+  select s.id, c.id, x.tier, 'pending'
+  from jsonb_to_recordset(matches) as x(email text, company text, tier text)
+  join sweek_students s on s.email = x.email
+  join sweek_companies c on c.name = x.company
+  on conflict (student_id, company_id) do nothing;
+
+  -- Only new students' tokens are returned; existing students keep their links
+  return query
+  select s.id, s.email, s.name, case when s.email = any(new_emails) then s.token end
+  from sweek_students s
+  where s.email in (select x.email from jsonb_to_recordset(students) as x(email text));
+end;
+$$;
+
+-- Functions in public are callable through /rpc by any role, including the
+-- anon key the web app ships to browsers. This one rewrites matches and
+-- returns tokens, so only the service role (used by sync_script.py) may call it
+revoke execute on function sweek_sync(jsonb, jsonb, jsonb) from public, anon, authenticated;
+grant execute on function sweek_sync(jsonb, jsonb, jsonb) to service_role;
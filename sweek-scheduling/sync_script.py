@@ -9,20 +9,32 @@ CSV Formats:
 - Wide form: email,name,companies (semicolon-separated),tier_top10 (semicolon-separated)
 """
 
+import base64
 import csv
 import hashlib
+import json
 import secrets
 import sys
 import os
-from typing import Dict, List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Optional
 from dataclasses import dataclass
 from supabase import create_client, Client
 import argparse
 
 # Configuration
 APP_BASE_URL = os.getenv('APP_BASE_URL', 'http://localhost:3000')
+CHUNK_SIZE = 1000  # Rows per bulk request, to stay within PostgREST request limits
+LOOKUP_CHUNK_SIZE = 200  # Values per .in_() filter; these go in the URL, which is shorter
+FALLBACK_CONCURRENCY = 16  # Single-row requests in flight when retrying a failed chunk
+VALID_TIERS = ('Top 10', 'Match')  # sweek_matches.tier check constraint
+TOKEN_BYTES = 32  # Random bytes per student token
+QUIET = False  # Set by --quiet to skip per-row output
+SYNC_CACHE_FILE = '.sync-cache.json'  # Digest of the CSVs last synced to each database
+failed_writes = 0  # Rows that could not be written this run; a sync with failures is not cached
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Company:
     name: str
     blurb: Optional[str] = None
@@ -31,14 +43,14 @@ class Company:
     scheduling_url: Optional[str] = None
     website_url: Optional[str] = None
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Student:
+    id: str
     email: str
     name: str
-    token: str
-    token_hash: str
+    token: Optional[str] = None  # Only set for students created by this sync
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Match:
     student_email: str
     student_name: str
@@ -46,244 +58,479 @@ class Match:
     tier: str
     stage: str
 
-def generate_token() -> str:
-    """Generate a random token for student authentication."""
-    return secrets.token_urlsafe(32)
+def chunked(rows: List[Dict], size: int = CHUNK_SIZE) -> Iterator[List[Dict]]:
+    """Yield successive lists of at most `size` rows."""
+    it = iter(rows)
+    while chunk := list(islice(it, size)):
+        yield chunk
 
-def hash_token(token: str) -> str:
-    """Hash token with SHA-256."""
-    return hashlib.sha256(token.encode()).hexdigest()
+def fetch_by(supabase: Client, table: str, columns: str, key: str, values: List[str]) -> Dict[str, Dict]:
+    """Fetch rows whose `key` is in `values` with one query per chunk; returns key -> row."""
+    rows = {}
+    for i in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        result = supabase.table(table).select(columns).in_(key, values[i:i + LOOKUP_CHUNK_SIZE]).execute()
+        rows.update((row[key], row) for row in result.data)
+    return rows
 
-def detect_csv_format(file_path: str) -> str:
-    """Detect if CSV is in long or wide format."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        header = next(reader)
-        
-        if 'company' in header and 'tier' in header and 'stage' in header:
-            return 'long'
-        elif 'companies' in header:
-            return 'wide'
-        else:
-            raise ValueError(f"Unknown CSV format. Header: {header}")
+def bulk_write(query: Callable, rows: List[Dict], describe: Callable[[Dict], str]) -> List[Dict]:
+    """Write rows in chunks with query(rows).execute(), falling back to one row at a time
+    for a chunk that fails. Returns the rows that were written, as returned by the
+    server if the query asks for them, otherwise as sent."""
+    global failed_writes
+    
+    def write_row(row: Dict) -> Tuple[List[Dict], Optional[Exception]]:
+        try:
+            return query(row).execute().data or [row], None
+        except Exception as e:
+            return [], e
+    
+    written = []
+    for chunk in chunked(rows):
+        try:
+            # With returning='minimal' the response has no rows; use the rows sent
+            written.extend(query(chunk).execute().data or chunk)
+        except Exception as e:
+            # The bulk call is all-or-nothing; retry this chunk row by row
+            # so one bad row doesn't block the rest. The rows are independent
+            # and the time is spent waiting on the network, so send them concurrently
+            print(f"  ✗ Bulk write failed ({e}), retrying {len(chunk)} rows individually")
+            with ThreadPoolExecutor(max_workers=FALLBACK_CONCURRENCY) as pool:
+                results = list(pool.map(write_row, chunk))
+            for row, (result, error) in zip(chunk, results):
+                if error:
+                    failed_writes += 1
+                    print(f"  ✗ Error {describe(row)}: {error}")
+                else:
+                    written.extend(result)
+    return written
+
+def write_lines(lines: List[str]) -> None:
+    """Write buffered per-row output with one write call (skipped with --quiet)."""
+    if lines and not QUIET:
+        sys.stdout.write('\n'.join(lines) + '\n')
+
+def generate_tokens(n: int) -> List[str]:
+    """Generate n random tokens for student authentication from a single
+    token_bytes call; each matches secrets.token_urlsafe(TOKEN_BYTES)."""
+    raw = secrets.token_bytes(TOKEN_BYTES * n)
+    return [base64.urlsafe_b64encode(raw[i:i + TOKEN_BYTES]).rstrip(b'=').decode('ascii')
+            for i in range(0, len(raw), TOKEN_BYTES)]
+
+def hash_tokens(tokens: List[str]) -> List[str]:
+    """Hash tokens with SHA-256, copying one initialized context per token
+    instead of creating a new one."""
+    base = hashlib.sha256()
+    hashes = []
+    for token in tokens:
+        h = base.copy()
+        h.update(token.encode())
+        hashes.append(h.hexdigest())
+    return hashes
+
+def strip_row(row: List[str], width: int) -> List[str]:
+    """Strip every value of a CSV row once. Fields past `width` (the header length)
+    are dropped, as DictReader did, and the row is padded with '' to width + 1."""
+    row = row[:width]
+    return [v.strip() for v in row] + [''] * (width + 1 - len(row))
 
-def parse_long_format(file_path: str) -> List[Match]:
-    """Parse long format CSV: email,name,company,tier,stage"""
+def optional_columns(header: List[str], columns: Tuple[str, ...]) -> Tuple[int, ...]:
+    """Resolve optional column names to positions. A missing column maps to
+    len(header), which strip_row always fills with ''."""
+    return tuple(header.index(c) if c in header else len(header) for c in columns)
+
+def detect_csv_format(header: List[str]) -> str:
+    """Detect if a CSV header is in long or wide format."""
+    if 'company' in header and 'tier' in header and 'stage' in header:
+        return 'long'
+    elif 'companies' in header:
+        return 'wide'
+    else:
+        raise ValueError(f"Unknown CSV format. Header: {header}")
+
+def parse_long_format(rows: Iterator[List[str]], header: List[str]) -> List[Match]:
+    """Parse long format rows: email,name,company,tier,stage"""
+    email, name, company, tier, stage = map(header.index, ('email', 'name', 'company', 'tier', 'stage'))
+    width = len(header)
+    
     matches = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            matches.append(Match(
-                student_email=row['email'].strip(),
-                student_name=row['name'].strip(),
-                company_name=row['company'].strip(),
-                tier=row['tier'].strip(),
-                stage=row['stage'].strip()
-            ))
+    for row in filter(None, rows):  # Skip blank lines
+        row = strip_row(row, width)
+        matches.append(Match(
+            student_email=row[email],
+            student_name=row[name],
+            company_name=row[company],
+            tier=row[tier],
+            stage=row[stage]
+        ))
     return matches
 
-def parse_wide_format(file_path: str) -> List[Match]:
-    """Parse wide format CSV: email,name,companies (all companies are Top 10)"""
+def parse_wide_format(rows: Iterator[List[str]], header: List[str]) -> List[Match]:
+    """Parse wide format rows: email,name,companies (all companies are Top 10)"""
+    email_idx, name_idx, companies_idx = map(header.index, ('email', 'name', 'companies'))
+    width = len(header)
+    
     matches = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            email = row['email'].strip()
-            name = row['name'].strip()
-            
-            companies = [c.strip() for c in row['companies'].split(';') if c.strip()]
-            
-            for company in companies:
-                # All companies in this CSV are Top 10 matches
-                matches.append(Match(
-                    student_email=email,
-                    student_name=name,
-                    company_name=company,
-                    tier="Top 10",  # All matches are Top 10
-                    stage='assigned'  # Default stage
-                ))
+    for row in filter(None, rows):  # Skip blank lines
+        row = strip_row(row, width)
+        email = row[email_idx]
+        name = row[name_idx]
+        
+        # All companies in this CSV are Top 10 matches
+        matches.extend(Match(
+            student_email=email,
+            student_name=name,
+            company_name=company,
+            tier="Top 10",  # All matches are Top 10
+            stage='assigned'  # Default stage
+        ) for company in map(str.strip, row[companies_idx].split(';')) if company)
     return matches
 
+def parse_student_matches(file_path: str) -> Tuple[str, List[Match]]:
+    """Parse a student matches CSV in one pass, detecting its format from the header.
+    Returns (format, matches)."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        format_type = detect_csv_format(header)
+        
+        if format_type == 'long':
+            return format_type, parse_long_format(reader, header)
+        return format_type, parse_wide_format(reader, header)
+
 def parse_companies_csv(file_path: str) -> Dict[str, Company]:
     """Parse companies CSV and return dict of company_name -> Company."""
     companies = {}
     with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            name = row['name'].strip()
+        reader = csv.reader(f)
+        header = next(reader, [])
+        name_idx = header.index('name')
+        blurb, learn_more_url, logo_slug, scheduling_url, website_url = optional_columns(
+            header, ('blurb', 'learn_more_url', 'logo_slug', 'scheduling_url', 'website_url'))
+        width = len(header)
+        
+        for row in filter(None, reader):  # Skip blank lines
+            row = strip_row(row, width)
+            name = row[name_idx]
             companies[name] = Company(
                 name=name,
-                blurb=row.get('blurb', '').strip() or None,
-                learn_more_url=row.get('learn_more_url', '').strip() or None,
-                logo_slug=row.get('logo_slug', '').strip() or None,
-                scheduling_url=row.get('scheduling_url', '').strip() or None,
-                website_url=row.get('website_url', '').strip() or None
+                blurb=row[blurb] or None,
+                learn_more_url=row[learn_more_url] or None,
+                logo_slug=row[logo_slug] or None,
+                scheduling_url=row[scheduling_url] or None,
+                website_url=row[website_url] or None
             )
     return companies
 
+def validate_matches(companies: Dict[str, Company], matches: List[Match]) -> List[str]:
+    """Check the parsed CSVs before touching the database; returns a list of problems."""
+    problems = []
+    
+    unknown = sorted({match.company_name for match in matches} - companies.keys())
+    if unknown:
+        problems.append(f"{len(unknown)} companies in matches are not in the companies CSV: {', '.join(unknown)}")
+    
+    bad_emails = [email for email in student_names(matches) if '@' not in email]
+    if bad_emails:
+        problems.append(f"{len(bad_emails)} invalid student emails: {', '.join(repr(e) for e in bad_emails)}")
+    
+    bad_tiers = sorted({match.tier for match in matches} - set(VALID_TIERS))
+    if bad_tiers:
+        problems.append(f"Invalid tiers {bad_tiers}, expected one of {list(VALID_TIERS)}")
+    
+    return problems
+
+def company_rows(companies: Dict[str, Company]) -> List[Dict]:
+    """Build the sweek_companies rows to write, leaving out unset (None) columns."""
+    return [{k: v for k, v in (
+        ('name', company.name),
+        ('blurb', company.blurb),
+        ('learn_more_url', company.learn_more_url),
+        ('logo_slug', company.logo_slug),
+        ('scheduling_url', company.scheduling_url or f"https://calendly.com/{company.name.lower().replace(' ', '-')}"),
+        ('website_url', company.website_url),
+        ('is_active', True)
+    ) if v is not None} for company in companies.values()]
+
 def upsert_companies(supabase: Client, companies: Dict[str, Company]) -> None:
     """Upsert companies to Supabase."""
     print(f"Upserting {len(companies)} companies...")
     
-    for company in companies.values():
-        company_data = {
-            'name': company.name,
-            'blurb': company.blurb,
-            'learn_more_url': company.learn_more_url,
-            'logo_slug': company.logo_slug,
-            'scheduling_url': company.scheduling_url or f"https://calendly.com/{company.name.lower().replace(' ', '-')}",
-            'website_url': company.website_url,
-            'is_active': True
-        }
-        
-        # Remove None values
-        company_data = {k: v for k, v in company_data.items() if v is not None}
-        
-        try:
-            supabase.table('sweek_companies').upsert(company_data, on_conflict='name').execute()
-            print(f"  ✓ {company.name}")
-        except Exception as e:
-            print(f"  ✗ Error upserting {company.name}: {e}")
+    rows = company_rows(companies)
+    
+    # A bulk upsert writes the same columns for every row, so group rows by the
+    # columns they set; otherwise a missing blurb would overwrite the stored one
+    groups: Dict[Tuple[str, ...], List[Dict]] = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+    
+    # The rows written are known locally, so skip sending them back (returning='minimal')
+    upsert = lambda chunk: supabase.table('sweek_companies').upsert(chunk, on_conflict='name', returning='minimal')
+    upserted = 0
+    for group in groups.values():
+        written = bulk_write(upsert, group, lambda row: f"upserting {row['name']}")
+        upserted += len(written)
+    
+    failed = len(rows) - upserted
+    print(f"  ✓ {upserted} companies upserted" + (f", ✗ {failed} failed" if failed else ""))
+
+def student_names(matches: List[Match]) -> Dict[str, str]:
+    """Map each student email to its name from the first match, in CSV order."""
+    name_by_email = {}
+    for match in matches:
+        name_by_email.setdefault(match.student_email, match.student_name)
+    return name_by_email
 
 def upsert_students(supabase: Client, matches: List[Match]) -> Dict[str, Student]:
     """Upsert students and return dict of email -> Student."""
     print("Upserting students...")
     
-    # Get unique students from matches
-    student_emails = list(set(match.student_email for match in matches))
+    # Get unique students and their names from matches in one pass
+    name_by_email = student_names(matches)
+    student_emails = list(name_by_email)
     students = {}
     
-    for email in student_emails:
-        # Get student name from first match
-        student_name = next((match.student_name for match in matches if match.student_email == email), email.split('@')[0].replace('.', ' ').title())
-        
-        # Try to find existing student
-        existing = supabase.table('sweek_students').select('*').eq('email', email).execute()
-        
-        if existing.data:
-            # Student exists, update name and use existing token
-            student_data = existing.data[0]
-            
-            # Update the name if it's different
+    # Find existing students with one query per chunk instead of one per email.
+    # Their tokens are left in the database; only new students' tokens are needed here
+    existing_rows = fetch_by(supabase, 'sweek_students', 'id,email,name', 'email', student_emails)
+    
+    to_update = []
+    to_insert = []
+    lines = []
+    for email, student_name in name_by_email.items():
+        student_data = existing_rows.get(email)
+        if student_data:
+            # Student exists, update name and keep existing token
             if student_data['name'] != student_name:
-                supabase.table('sweek_students').update({'name': student_name}).eq('email', email).execute()
-                print(f"  ✓ {email} (updated name: {student_name})")
+                to_update.append({'email': email, 'name': student_name})
+                lines.append(f"  ✓ {email} (updated name: {student_name})")
             else:
-                print(f"  ✓ {email} (existing)")
+                lines.append(f"  ✓ {email} (existing)")
                 
             students[email] = Student(
+                id=student_data['id'],
                 email=email,
-                name=student_name,  # Use the name from CSV
-                token=student_data['token'],
-                token_hash=student_data['token_hash']
+                name=student_name  # Use the name from CSV
             )
         else:
-            # New student, generate token
-            token = generate_token()
-            token_hash = hash_token(token)
-            
-            student_data = {
+            # New student, token generated below
+            to_insert.append({
                 'email': email,
                 'name': student_name,
-                'token': token,
-                'token_hash': token_hash,
                 'is_active': True
-            }
-            
-            try:
-                result = supabase.table('sweek_students').insert(student_data).execute()
-                students[email] = Student(
-                    email=email,
-                    name=student_name,
-                    token=token,
-                    token_hash=token_hash
-                )
-                print(f"  ✓ {email} (new)")
-            except Exception as e:
-                print(f"  ✗ Error creating student {email}: {e}")
+            })
+    
+    # Generate and hash tokens for all new students at once
+    tokens = generate_tokens(len(to_insert))
+    for row, token, token_hash in zip(to_insert, tokens, hash_tokens(tokens)):
+        row['token'] = token
+        row['token_hash'] = token_hash
+    
+    # Upsert rows must satisfy the NOT NULL token columns, so carry the stored
+    # tokens for renamed students only, then apply all name changes as one upsert per chunk
+    if to_update:
+        tokens = fetch_by(supabase, 'sweek_students', 'email,token,token_hash', 'email',
+                          [row['email'] for row in to_update])
+        for row in to_update:
+            row.update(tokens.get(row['email'], {}))
+    bulk_write(lambda chunk: supabase.table('sweek_students').upsert(chunk, on_conflict='email', returning='minimal'),
+               to_update, lambda row: f"updating student {row['email']}")
     
+    # Create all new students as one insert per chunk, returning their new ids
+    inserted = bulk_write(lambda chunk: supabase.table('sweek_students').insert(chunk),
+                          to_insert, lambda row: f"creating student {row['email']}")
+    for row in inserted:
+        students[row['email']] = Student(
+            id=row['id'],
+            email=row['email'],
+            name=row['name'],
+            token=row['token']
+        )
+        lines.append(f"  ✓ {row['email']} (new)")
+    
+    write_lines(lines)
+    failed = len(name_by_email) - len(students)
+    print(f"  ✓ {len(students)} students ({len(inserted)} new, {len(to_update)} renamed)"
+          + (f", ✗ {failed} failed" if failed else ""))
     return students
 
-def replace_student_matches(supabase: Client, matches: List[Match], students: Dict[str, Student]) -> None:
-    """Replace all matches for each student with new matches from CSV."""
-    print("Replacing student matches...")
-    
-    # Group matches by student
-    student_matches = {}
+def build_match_rows(matches: List[Match], student_id_by_email: Dict[str, str],
+                     company_id_by_name: Dict[str, str]) -> List[Dict]:
+    """Build sweek_matches rows for the given students, skipping unknown companies
+    and repeated (student, company) pairs, which the primary key would reject."""
+    match_rows = []
+    seen = set()
     for match in matches:
-        if match.student_email not in student_matches:
-            student_matches[match.student_email] = []
-        student_matches[match.student_email].append(match)
-    
-    for email, student_matches_list in student_matches.items():
-        if email not in students:
-            print(f"  ✗ Student {email} not found, skipping matches")
+        student_id = student_id_by_email.get(match.student_email)
+        if not student_id:
             continue
         
-        student = students[email]
-        
-        # Get student UUID from database
-        student_result = supabase.table('sweek_students').select('id').eq('email', email).execute()
-        if not student_result.data:
-            print(f"  ✗ Student {email} not found in database, skipping matches")
+        company_id = company_id_by_name.get(match.company_name)
+        if not company_id:
+            print(f"  ✗ Company {match.company_name} not found, skipping match")
             continue
         
-        student_id = student_result.data[0]['id']
-        
-        # Delete existing matches for this student
-        try:
-            supabase.table('sweek_matches').delete().eq('student_id', student_id).execute()
-        except Exception as e:
-            print(f"  ✗ Error deleting existing matches for {email}: {e}")
+        if (student_id, company_id) in seen:
+            print(f"  ✗ Duplicate match {match.student_email} -> {match.company_name}, keeping the first")
             continue
+        seen.add((student_id, company_id))
         
-        # Insert new matches
-        for match in student_matches_list:
-            # Get company ID
-            company_result = supabase.table('sweek_companies').select('id').eq('name', match.company_name).execute()
-            if not company_result.data:
-                print(f"  ✗ Company {match.company_name} not found, skipping match")
-                continue
-            
-            company_id = company_result.data[0]['id']
-            
-            match_data = {
-                'student_id': student_id,  # Use actual UUID
-                'company_id': company_id,
-                'tier': match.tier,
-                'stage': 'pending'  # Default stage for new matches
-            }
-            
+        match_rows.append({
+            'student_id': student_id,  # Use actual UUID
+            'company_id': company_id,
+            'tier': match.tier,
+            'stage': 'pending'  # Default stage for new matches
+        })
+    return match_rows
+
+def connect_database(database_url: str) -> Optional[Any]:
+    """Open a direct Postgres connection for COPY, or return None (with a warning)
+    so the sync uses the REST API instead."""
+    try:
+        import psycopg  # Optional dependency, only needed when DATABASE_URL is set
+    except ImportError:
+        print("⚠️  DATABASE_URL is set but psycopg is not installed (pip install \"psycopg[binary]\"); "
+              "using the REST API for matches")
+        return None
+    
+    try:
+        return psycopg.connect(database_url)
+    except psycopg.OperationalError as e:
+        print(f"⚠️  Could not connect to DATABASE_URL ({e}); using the REST API for matches")
+        return None
+
+def copy_student_matches(conn: Any, student_ids: List[str], match_rows: List[Dict]) -> None:
+    """Replace matches over a direct Postgres connection: one DELETE and one COPY
+    in a single transaction."""
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("DELETE FROM sweek_matches WHERE student_id = ANY(%s::uuid[])", (student_ids,))
+        with cur.copy("COPY sweek_matches (student_id, company_id, tier, stage) FROM STDIN") as copy:
+            for row in match_rows:
+                copy.write_row((row['student_id'], row['company_id'], row['tier'], row['stage']))
+
+def replace_student_matches(supabase: Client, matches: List[Match], students: Dict[str, Student],
+                            conn: Optional[Any] = None) -> None:
+    """Replace all matches for each student with new matches from CSV. With a
+    Postgres connection (see connect_database), the delete and insert go over it."""
+    global failed_writes
+    
+    print("Replacing student matches...")
+    
+    # Student IDs come from upsert_students; resolve every company ID up front
+    student_id_by_email = {}
+    for email in dict.fromkeys(match.student_email for match in matches):
+        if email not in students:
+            print(f"  ✗ Student {email} not found, skipping matches")
+            continue
+        student_id_by_email[email] = students[email].id
+    
+    company_names = list({match.company_name for match in matches})
+    company_id_by_name = {name: row['id'] for name, row in
+                          fetch_by(supabase, 'sweek_companies', 'id,name', 'name', company_names).items()}
+    
+    email_by_id = {student_id: email for email, student_id in student_id_by_email.items()}
+    company_by_id = {company_id: name for name, company_id in company_id_by_name.items()}
+    describe = lambda row: f"{email_by_id[row['student_id']]} -> {company_by_id[row['company_id']]} ({row['tier']})"
+    
+    if conn:
+        # COPY skips PostgREST's per-row JSON handling; the transaction is all-or-nothing
+        match_rows = build_match_rows(matches, student_id_by_email, company_id_by_name)
+        copy_student_matches(conn, list(student_id_by_email.values()), match_rows)
+        inserted = match_rows
+    else:
+        # Delete existing matches for all these students, one request per chunk
+        student_ids = list(student_id_by_email.values())
+        cleared = set()
+        for i in range(0, len(student_ids), LOOKUP_CHUNK_SIZE):
+            chunk_ids = student_ids[i:i + LOOKUP_CHUNK_SIZE]
             try:
-                supabase.table('sweek_matches').insert(match_data).execute()
-                print(f"  ✓ {email} -> {match.company_name} ({match.tier})")
+                supabase.table('sweek_matches').delete().in_('student_id', chunk_ids).execute()
+                cleared.update(chunk_ids)
             except Exception as e:
-                print(f"  ✗ Error creating match {email} -> {match.company_name}: {e}")
+                failed_writes += len(chunk_ids)
+                print(f"  ✗ Error deleting existing matches for {len(chunk_ids)} students: {e}")
+        
+        # Insert new matches for the cleared students, one request per chunk
+        match_rows = build_match_rows(matches, {email: student_id for email, student_id in
+                                                student_id_by_email.items() if student_id in cleared},
+                                      company_id_by_name)
+        inserted = bulk_write(lambda chunk: supabase.table('sweek_matches').insert(chunk, returning='minimal'),
+                              match_rows, lambda row: f"creating match {describe(row)}")
+    
+    write_lines([f"  ✓ {describe(row)}" for row in inserted])
+    
+    failed = len(match_rows) - len(inserted)
+    print(f"  ✓ {len(inserted)} matches inserted" + (f", ✗ {failed} failed" if failed else ""))
+
+def sync_via_rpc(supabase: Client, companies: Dict[str, Company], matches: List[Match]) -> Dict[str, Student]:
+    """Run the whole sync as one transaction via the sweek_sync Postgres function
+    (see sweek_sync.sql) and return dict of email -> Student."""
+    print(f"Syncing {len(companies)} companies and {len(matches)} matches via sweek_sync...")
+    
+    result = supabase.rpc('sweek_sync', {
+        'companies': company_rows(companies),
+        'students': [{'email': email, 'name': name} for email, name in student_names(matches).items()],
+        'matches': [{'email': m.student_email, 'company': m.company_name, 'tier': m.tier} for m in matches]
+    }).execute()
+    
+    students = {row['email']: Student(**row) for row in result.data}
+    print(f"  ✓ {len(students)} students synced")
+    return students
+
+def csv_digest(*paths: str) -> str:
+    """SHA-256 over the contents of the given CSV files."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def load_sync_cache() -> Dict[str, str]:
+    """Load the database URL -> CSV digest map of previous successful syncs."""
+    try:
+        with open(SYNC_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_sync_cache(cache: Dict[str, str]) -> None:
+    """Save the database URL -> CSV digest map."""
+    with open(SYNC_CACHE_FILE, 'w') as f:
+        json.dump(cache, f, indent=2)
 
 def print_magic_links(students: Dict[str, Student]) -> None:
     """Print magic links for new students."""
-    print("\n" + "="*60)
-    print("MAGIC LINKS FOR EMAILING")
-    print("="*60)
+    lines = ["\n" + "="*60, "MAGIC LINKS FOR EMAILING", "="*60]
     
     for email, student in students.items():
-        magic_link = f"{APP_BASE_URL}/s/{student.token}"
-        print(f"{email}: {magic_link}")
+        if student.token:
+            magic_link = f"{APP_BASE_URL}/s/{student.token}"
+            lines.append(f"{email}: {magic_link}")
+    
+    if len(lines) == 3:
+        lines.append("No new students (existing students keep their links)")
     
-    print("="*60)
+    lines.append("="*60)
+    write_lines(lines)
 
 def main():
-    global APP_BASE_URL
+    global APP_BASE_URL, QUIET
     
     parser = argparse.ArgumentParser(description='Sync companies and student matches to Supabase')
     parser.add_argument('company_csv', help='Path to companies CSV file')
     parser.add_argument('student_matches_csv', help='Path to student matches CSV file')
     parser.add_argument('--app-url', default=APP_BASE_URL, help='Base URL for magic links')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Only print totals, not every student, match and magic link')
+    parser.add_argument('--force', action='store_true',
+                        help='Sync even if the CSVs are unchanged since the last successful sync')
+    parser.add_argument('--rpc', action='store_true',
+                        help='Sync in one transaction via the sweek_sync database function (see sweek_sync.sql)')
     
     args = parser.parse_args()
     
-    # Set global APP_BASE_URL
+    # Set global APP_BASE_URL and QUIET
     APP_BASE_URL = args.app_url
+    QUIET = args.quiet
     
     # Initialize Supabase client
     supabase_url = os.getenv('SUPABASE_URL')
@@ -295,36 +542,58 @@ def main():
     
     # Use service role key for admin operations (bypasses RLS)
     supabase: Client = create_client(supabase_url, supabase_key)
+    conn = None
     
     try:
-        # Parse companies CSV
-        print("Parsing companies CSV...")
-        companies = parse_companies_csv(args.company_csv)
-        print(f"Found {len(companies)} companies")
+        # Skip the sync entirely if these exact CSVs were already synced to this database
+        sync_cache = load_sync_cache()
+        digest = csv_digest(args.company_csv, args.student_matches_csv)
+        if not args.force and sync_cache.get(supabase_url) == digest:
+            print("✅ CSVs unchanged since the last successful sync, nothing to do (use --force to sync anyway)")
+            return
         
-        # Parse student matches CSV
-        print("\nParsing student matches CSV...")
-        format_type = detect_csv_format(args.student_matches_csv)
-        print(f"Detected {format_type} format")
-        
-        if format_type == 'long':
-            matches = parse_long_format(args.student_matches_csv)
-        else:
-            matches = parse_wide_format(args.student_matches_csv)
+        # Parse both CSVs concurrently; they are independent and their reads overlap
+        print("Parsing companies and student matches CSVs...")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            companies_future = pool.submit(parse_companies_csv, args.company_csv)
+            matches_future = pool.submit(parse_student_matches, args.student_matches_csv)
+            companies = companies_future.result()
+            format_type, matches = matches_future.result()
         
+        print(f"Found {len(companies)} companies")
+        print(f"Detected {format_type} format")
         print(f"Found {len(matches)} matches")
         
-        # Upsert companies
-        print("\n" + "="*60)
-        upsert_companies(supabase, companies)
-        
-        # Upsert students
-        print("\n" + "="*60)
-        students = upsert_students(supabase, matches)
+        # Validate everything up front so a bad CSV can't leave a partial sync behind
+        problems = validate_matches(companies, matches)
+        if problems:
+            print("\n❌ CSV validation failed, nothing was synced:")
+            for problem in problems:
+                print(f"   - {problem}")
+            sys.exit(1)
         
-        # Replace student matches
-        print("\n" + "="*60)
-        replace_student_matches(supabase, matches, students)
+        if args.rpc:
+            # Upsert companies, students and matches in one round trip
+            print("\n" + "="*60)
+            students = sync_via_rpc(supabase, companies, matches)
+        else:
+            # Open the optional direct connection before writing anything, so an
+            # unusable DATABASE_URL falls back to REST instead of failing mid-sync
+            database_url = os.getenv('DATABASE_URL')
+            if database_url:
+                conn = connect_database(database_url)
+            
+            # Upsert companies
+            print("\n" + "="*60)
+            upsert_companies(supabase, companies)
+            
+            # Upsert students
+            print("\n" + "="*60)
+            students = upsert_students(supabase, matches)
+            
+            # Replace student matches
+            print("\n" + "="*60)
+            replace_student_matches(supabase, matches, students, conn)
         
         # Print magic links
         print_magic_links(students)
@@ -334,9 +603,18 @@ def main():
         print(f"   - {len(students)} students processed")
         print(f"   - {len(matches)} matches processed")
         
+        if failed_writes:
+            print(f"   - ✗ {failed_writes} writes failed, re-run to retry")
+        else:
+            sync_cache[supabase_url] = digest
+            save_sync_cache(sync_cache)
+        
     except Exception as e:
         print(f"❌ Error during sync: {e}")
         sys.exit(1)
+    finally:
+        if conn:
+            conn.close()
 
 if __name__ == "__main__":
     main()